@@ -1,5 +1,7 @@
 from toggle_service.app import create_app
 
-# Expose a module-level ASGI app so uvicorn/gunicorn can load it:
+# Expose a module-level ASGI app so uvicorn/gunicorn can load it.
+# uvicorn's default `--loop auto` picks uvloop when it is installed (see
+# requirements.txt), so no explicit loop policy is set here.
 app = create_app()
 
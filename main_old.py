@@ -4,8 +4,10 @@ import asyncio
 import os
 import tempfile
 import json
+import logging
 
 app = FastAPI(title="Toggle Service")
+logger = logging.getLogger(__name__)
 
 # file used to persist
 # TODO - understand how TOGGLES_FILE will be injected by compose etc
@@ -18,6 +20,9 @@ toggles = {}
 _store_lock = asyncio.Lock()
 
 # ---------- Persistence helpers ----------
+# Built once and reused; compact and unsorted so encoding stays on the C path.
+_ENCODER = json.JSONEncoder(separators=(",", ":"))
+
 def _save_sync(path: str, data: dict) -> None:
     """
     Perform an atomic write of `data` to `path` by writing to a temp file
@@ -31,18 +36,19 @@ def _save_sync(path: str, data: dict) -> None:
     fd, tmp_path = tempfile.mkstemp(dir=dirpath)
     try:
         with os.fdopen(fd, "w", encoding="utf-8") as f:
-            json.dump(data, f, indent=2, sort_keys=True)
+            f.write(_ENCODER.encode(data))
             f.flush()
             os.fsync(f.fileno())
         # Atomic replace
         os.replace(tmp_path, path)
-    finally:
-        # If anything left, remove temp file
-        if os.path.exists(tmp_path):
-            try:
-                os.remove(tmp_path)
-            except OSError:
-                pass
+    except BaseException:
+        # The temp file is only left behind on failure; removing it here
+        # avoids an exists() stat on every successful write.
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
 
 
 def _load_sync(path: str) -> dict:
@@ -50,8 +56,6 @@ def _load_sync(path: str) -> dict:
     Synchronously load toggles from path. Returns empty dict on missing
     or invalid JSON.
     """
-    if not os.path.exists(path):
-        return {}
     try:
         with open(path, "r", encoding="utf-8") as f:
             data = json.load(f)
@@ -96,16 +100,9 @@ async def on_shutdown():
 # ---------- Middleware ----------
 @app.middleware("http")
 async def log_request(request: Request, call_next):
-    body = await request.body()
-    print(f"Incoming request: {request.method} {request.url}")
-    print(f"Headers: {dict(request.headers)}")
-    if body:
-        try:
-            print(f"Body: {body.decode('utf-8')}")
-        except Exception:
-            print("Body: <binary data>")
-    response = await call_next(request)
-    return response
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Incoming request: %s %s", request.method, request.url.path)
+    return await call_next(request)
 
 # ---------- Endpoints ----------
 @app.post("/create")
@@ -1,7 +1,14 @@
+import asyncio
+import errno
 import json
+import os
+import uuid
 import pytest
 from httpx import AsyncClient, ASGITransport
-from toggle_service.app import create_app
+import toggle_service.app as app_module
+import toggle_service.persistence as persistence
+from toggle_service.app import create_app, fast_guid
+from toggle_service.persistence import JOURNAL_RECORD, pack_record
 
 
 @pytest.mark.asyncio
@@ -9,21 +16,22 @@ async def test_persistence_roundtrip(tmp_path):
     path = tmp_path / "toggles.json"
     app = create_app(str(path))
 
-    transport = ASGITransport(app=app)
-    async with AsyncClient(transport=transport, base_url="http://localhost:8009") as ac:
-        # create a toggle
-        r = await ac.post("/create")
-        assert r.status_code == 200
-        data = r.json()
-        guid = data["guid"]
-        assert data["state"] is False
-
-        # toggle it
-        r2 = await ac.post(f"/toggle/{guid}")
-        assert r2.status_code == 200
-        assert r2.json()["state"] is True
-
-    # After the client context, the app should have run shutdown and saved the file
+    async with app.router.lifespan_context(app):
+        transport = ASGITransport(app=app)
+        async with AsyncClient(transport=transport, base_url="http://localhost:8009") as ac:
+            # create a toggle
+            r = await ac.post("/create")
+            assert r.status_code == 200
+            data = r.json()
+            guid = data["guid"]
+            assert data["state"] is False
+
+            # toggle it
+            r2 = await ac.post(f"/toggle/{guid}")
+            assert r2.status_code == 200
+            assert r2.json()["state"] is True
+
+    # After the lifespan context, the app should have run shutdown and saved the file
     content = json.loads(path.read_text(encoding="utf-8"))
     assert content.get(guid) is True
 
@@ -44,3 +52,228 @@ async def test_loads_on_startup(tmp_path):
             r = await ac.get(f"/status/{guid}")
             assert r.status_code == 200
             assert r.json()["state"] is True
+
+
+@pytest.mark.asyncio
+async def test_concurrent_creates_are_persisted(tmp_path):
+    path = tmp_path / "toggles.json"
+    app = create_app(str(path))
+
+    async with app.router.lifespan_context(app):
+        transport = ASGITransport(app=app)
+        async with AsyncClient(transport=transport, base_url="http://localhost:8009") as ac:
+            responses = await asyncio.gather(*(ac.post("/create") for _ in range(20)))
+            guids = {r.json()["guid"] for r in responses}
+
+    content = json.loads(path.read_text(encoding="utf-8"))
+    assert guids <= set(content)
+
+
+@pytest.mark.asyncio
+async def test_journal_replayed_without_shutdown(tmp_path):
+    path = tmp_path / "toggles.json"
+    app = create_app(str(path))
+
+    transport = ASGITransport(app=app)
+    async with AsyncClient(transport=transport, base_url="http://localhost:8009") as ac:
+        guid = (await ac.post("/create")).json()["guid"]
+        await ac.post(f"/toggle/{guid}")
+
+    # No shutdown ran, so the state only lives in the journal.
+    assert not path.exists()
+
+    app2 = create_app(str(path))
+    async with app2.router.lifespan_context(app2):
+        transport = ASGITransport(app=app2)
+        async with AsyncClient(transport=transport, base_url="http://localhost:8009") as ac:
+            r = await ac.get(f"/status/{guid}")
+            assert r.status_code == 200
+            assert r.json()["state"] is True
+
+
+def test_fast_guid_is_uuid4():
+    guids = {fast_guid() for _ in range(1000)}
+    assert len(guids) == 1000
+    for guid in guids:
+        parsed = uuid.UUID(guid)
+        assert parsed.version == 4
+        assert str(parsed) == guid
+
+
+@pytest.mark.asyncio
+async def test_status_tracks_toggles(tmp_path):
+    app = create_app(str(tmp_path / "toggles.json"))
+
+    async with app.router.lifespan_context(app):
+        transport = ASGITransport(app=app)
+        async with AsyncClient(transport=transport, base_url="http://localhost:8009") as ac:
+            guid = (await ac.post("/create")).json()["guid"]
+            for expected in (False, True, False):
+                r = await ac.get(f"/status/{guid}")
+                assert r.status_code == 200
+                assert r.json() == {"guid": guid, "state": expected}
+                await ac.post(f"/toggle/{guid}")
+
+            r = await ac.get(f"/status/{fast_guid()}")
+            assert r.status_code == 404
+
+            r = await ac.get("/status/not-a-guid")
+            assert r.status_code == 422
+            r = await ac.post(f"/toggle/{'x' * 4096}")
+            assert r.status_code == 422
+
+
+@pytest.mark.asyncio
+async def test_torn_journal_record_is_ignored(tmp_path):
+    path = tmp_path / "toggles.json"
+    app = create_app(str(path))
+
+    transport = ASGITransport(app=app)
+    async with AsyncClient(transport=transport, base_url="http://localhost:8009") as ac:
+        guid = (await ac.post("/create")).json()["guid"]
+        await ac.post(f"/toggle/{guid}")
+
+    # Simulate a crash part-way through appending another record.
+    with open(f"{path}.journal", "ab") as f:
+        f.write(b"\x00" * 5)
+
+    app2 = create_app(str(path))
+    async with app2.router.lifespan_context(app2):
+        transport = ASGITransport(app=app2)
+        async with AsyncClient(transport=transport, base_url="http://localhost:8009") as ac:
+            r2 = await ac.post(f"/toggle/{guid}")
+            assert r2.json()["state"] is False
+
+    content = json.loads(path.read_text(encoding="utf-8"))
+    assert content == {guid: False}
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="requires os.fork")
+def test_fast_guid_pool_not_shared_across_fork():
+    fast_guid()  # fill the pool in the parent
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(r)
+        os.write(w, fast_guid().encode())
+        os._exit(0)
+    os.close(w)
+    with os.fdopen(r) as f:
+        child_guid = f.read()
+    os.waitpid(pid, 0)
+    assert child_guid != fast_guid()
+
+
+@pytest.mark.asyncio
+async def test_snapshot_values_coerced_to_bool(tmp_path):
+    on, off = fast_guid(), fast_guid()
+    path = tmp_path / "toggles.json"
+    path.write_text(json.dumps({on: [1], off: None}), encoding="utf-8")
+
+    app = create_app(str(path))
+    async with app.router.lifespan_context(app):
+        transport = ASGITransport(app=app)
+        async with AsyncClient(transport=transport, base_url="http://localhost:8009") as ac:
+            assert (await ac.get(f"/status/{on}")).json()["state"] is True
+            assert (await ac.get(f"/status/{off}")).json()["state"] is False
+
+
+@pytest.mark.asyncio
+async def test_snapshot_keys_normalized_before_journal_replay(tmp_path):
+    guid = "58a2bbac-e534-4479-8da2-5f344d91de79"
+    path = tmp_path / "toggles.json"
+    path.write_text(json.dumps({guid.upper(): True, "not-a-guid": True}), encoding="utf-8")
+
+    app = create_app(str(path))
+    async with app.router.lifespan_context(app):
+        transport = ASGITransport(app=app)
+        async with AsyncClient(transport=transport, base_url="http://localhost:8009") as ac:
+            assert (await ac.get(f"/status/{guid.upper()}")).status_code == 422
+            r = await ac.post(f"/toggle/{guid}")
+            assert r.json()["state"] is False
+
+    # Simulate a crash after the flip: stale snapshot, flip only in the journal.
+    path.write_text(json.dumps({guid.upper(): True}), encoding="utf-8")
+    with open(f"{path}.journal", "wb") as f:
+        f.write(pack_record(guid, False))
+
+    app2 = create_app(str(path))
+    async with app2.router.lifespan_context(app2):
+        assert app2.state._toggles == {guid: False}
+
+
+@pytest.mark.asyncio
+async def test_journal_compacts_when_it_grows(tmp_path, monkeypatch):
+    # One toggle gives a limit of max(85, 10 * 17) = 170 bytes, i.e. the
+    # 11th record triggers compaction.
+    monkeypatch.setattr(app_module, "_COMPACT_MIN_BYTES", 5 * JOURNAL_RECORD.size)
+    path = tmp_path / "toggles.json"
+    journal = tmp_path / "toggles.json.journal"
+    app = create_app(str(path))
+
+    transport = ASGITransport(app=app)
+    async with AsyncClient(transport=transport, base_url="http://localhost:8009") as ac:
+        guid = (await ac.post("/create")).json()["guid"]
+        for _ in range(9):
+            await ac.post(f"/toggle/{guid}")
+        assert not path.exists()
+        assert journal.stat().st_size == 10 * JOURNAL_RECORD.size
+
+        await ac.post(f"/toggle/{guid}")
+        # The snapshot was rewritten mid-run and the journal truncated.
+        assert json.loads(path.read_text(encoding="utf-8")) == {guid: False}
+        assert journal.stat().st_size == 0
+
+        r = await ac.post(f"/toggle/{guid}")
+        assert r.json()["state"] is True
+        assert journal.stat().st_size == JOURNAL_RECORD.size
+
+    # No shutdown ran: a restart must replay the post-compaction record.
+    app2 = create_app(str(path))
+    async with app2.router.lifespan_context(app2):
+        assert app2.state._toggles == {guid: True}
+
+
+def test_failed_append_does_not_misalign_journal(tmp_path, monkeypatch):
+    path = str(tmp_path / "toggles.json")
+    first, second, third = fast_guid(), fast_guid(), fast_guid()
+    fd = persistence._open_journal_sync(path)
+    try:
+        persistence._append_sync(fd, [pack_record(first, True)])
+
+        def short_write_then_enospc(fd, buf):
+            os.write(fd, bytes(buf[:7]))
+            raise OSError(errno.ENOSPC, "No space left on device")
+
+        with monkeypatch.context() as m:
+            m.setattr(persistence, "_write_all", short_write_then_enospc)
+            with pytest.raises(OSError):
+                persistence._append_sync(fd, [pack_record(second, True)])
+
+        persistence._append_sync(fd, [pack_record(third, True)])
+    finally:
+        os.close(fd)
+
+    assert persistence._load_all_sync(path) == ({first: True, third: True}, [])
+
+
+@pytest.mark.asyncio
+async def test_non_guid_snapshot_keys_are_not_compacted_away(tmp_path, caplog):
+    guid = "58a2bbac-e534-4479-8da2-5f344d91de79"
+    path = tmp_path / "toggles.json"
+    original = json.dumps({"feature-x": True, guid: True})
+    path.write_text(original, encoding="utf-8")
+
+    app = create_app(str(path))
+    async with app.router.lifespan_context(app):
+        transport = ASGITransport(app=app)
+        async with AsyncClient(transport=transport, base_url="http://localhost:8009") as ac:
+            assert (await ac.post(f"/toggle/{guid}")).json()["state"] is False
+
+    assert "feature-x" in caplog.text
+    # Shutdown left the snapshot alone; the flip is kept in the journal.
+    assert path.read_text(encoding="utf-8") == original
+
+    app2 = create_app(str(path))
+    async with app2.router.lifespan_context(app2):
+        assert app2.state._toggles == {guid: False}
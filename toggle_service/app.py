@@ -1,82 +1,267 @@
-from fastapi import FastAPI, HTTPException, Request
-import uuid
+from fastapi import FastAPI, HTTPException, Request, Response
 import asyncio
-from typing import Dict, Optional
-from .persistence import load as _load_from_disk, save as _save_to_disk
+import functools
+import logging
+import os
+import re
+import threading
+import orjson
+from typing import Dict, List, Optional, Tuple
+from .persistence import (
+    load as _load_from_disk,
+    open_journal as _open_journal,
+    append as _append_to_disk,
+    compact as _compact_on_disk,
+    WriterThread,
+    JOURNAL_RECORD,
+    format_guid,
+    pack_record,
+)
 from contextlib import asynccontextmanager
 
+logger = logging.getLogger(__name__)
+
+# GUIDs are sliced from a pooled os.urandom buffer so that ~256 of them
+# cost one syscall, instead of one per uuid.uuid4() call.
+_GUID_POOL_SIZE = 4096
+_guid_pool = b""
+_guid_pos = 0
+_guid_lock = threading.Lock()
+
+
+def fast_guid() -> str:
+    """Return a random (version 4) UUID string, like str(uuid.uuid4())."""
+    global _guid_pool, _guid_pos
+    with _guid_lock:
+        if _guid_pos + 16 > len(_guid_pool):
+            _guid_pool = os.urandom(_GUID_POOL_SIZE)
+            _guid_pos = 0
+        b = bytearray(_guid_pool[_guid_pos:_guid_pos + 16])
+        _guid_pos += 16
+    b[6] = (b[6] & 0x0F) | 0x40  # version 4
+    b[8] = (b[8] & 0x3F) | 0x80  # RFC 4122 variant
+    return format_guid(b)
+
+
+def _reset_guid_pool() -> None:
+    # A forked child must not hand out the rest of its parent's pool.
+    global _guid_pool, _guid_pos, _guid_lock
+    _guid_pool = b""
+    _guid_pos = 0
+    _guid_lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_guid_pool)
+
+
+_GUID_RE = re.compile(r"[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}")
+
+
+def _valid_guid(s: str) -> bool:
+    """
+    Check that `s` is a canonical lowercase GUID, the only form stored and
+    journaled, before it is hashed. The length check bounds the regex work.
+    """
+    return len(s) == 36 and _GUID_RE.fullmatch(s) is not None
+
+
+@functools.lru_cache(maxsize=10_000)
+def _toggle_body(guid: str, state: bool) -> bytes:
+    """
+    Encoded `{"guid", "state"}` response body. Keyed by the state itself, so
+    a mutation never needs to invalidate anything: the next read just looks
+    up the new key.
+    """
+    return orjson.dumps({"guid": guid, "state": state})
+
+
+# The journal is never compacted below this size, so tiny stores don't
+# rewrite their snapshot on every mutation.
+_COMPACT_MIN_BYTES = 64 * 1024
+
 def create_app(toggles_file: Optional[str] = "toggles.json") -> FastAPI:
     """
     Factory to create a FastAPI app with an encapsulated in-memory store
     and persistence to `toggles_file`.
     """
+    # True/False are shared singletons, so each entry costs only its guid key
+    # and dict slot. Packing states into a bit array would still need a
+    # guid -> index map, and its int values take more memory than they save.
     toggles: Dict[str, bool] = {}
-    _store_lock = asyncio.Lock()
     TOGGLES_FILE = toggles_file or "toggles.json"
 
+    # --- write coalescing ---
+    # Mutations are recorded in an append-only journal next to TOGGLES_FILE.
+    # Each mutation queues its encoded record (packed on the loop, so a bad
+    # record fails only its own request) with a future in `_pending`; a single
+    # writer task drains the whole batch with one synchronous append, so N
+    # concurrent mutations cost one disk write instead of N. The journal is
+    # compacted into a fresh snapshot once it grows well past the store size,
+    # or when a `None` record is queued. Compaction runs in the writer task so
+    # it is ordered with appends: the snapshot covers every mutation made so
+    # far, and any record appended after the truncate is newer than it.
+    _pending: List[Tuple[Optional[bytes], asyncio.Future]] = []
+    _writer_task: Optional[asyncio.Task] = None
+    _disk_writer = WriterThread()
+    _journal_fd: Optional[int] = None
+    _journal_bytes = 0
+    # Set when the snapshot holds keys we can't represent (see on_startup).
+    # Compaction would delete them, so the snapshot is left untouched and
+    # mutations stay in the journal.
+    _keep_snapshot = False
+    # Serialized snapshot of `toggles`, reset to None on every mutation so
+    # repeated compactions of an unchanged store reuse the same bytes.
+    _serialized: Optional[bytes] = None
+
+    def _snapshot() -> bytes:
+        nonlocal _serialized
+        if _serialized is None:
+            _serialized = orjson.dumps(toggles)
+        return _serialized
+
+    async def _ensure_journal() -> int:
+        nonlocal _journal_fd, _journal_bytes
+        if _journal_fd is None:
+            _journal_fd = await _open_journal(TOGGLES_FILE, _disk_writer)
+            _journal_bytes = os.fstat(_journal_fd).st_size
+        return _journal_fd
+
+    async def _writer():
+        nonlocal _writer_task, _journal_bytes
+        try:
+            while _pending:
+                batch = _pending[:]
+                _pending.clear()
+                records = [record for record, _ in batch if record is not None]
+                try:
+                    fd = await _ensure_journal()
+                    if records:
+                        _journal_bytes += await _append_to_disk(_disk_writer, fd, records)
+                    limit = max(_COMPACT_MIN_BYTES, 10 * len(toggles) * JOURNAL_RECORD.size)
+                    compact = len(records) < len(batch) or _journal_bytes > limit
+                    if compact and not _keep_snapshot:
+                        await _compact_on_disk(_disk_writer, TOGGLES_FILE, fd, _snapshot())
+                        _journal_bytes = 0
+                except Exception as exc:
+                    for _, fut in batch:
+                        if not fut.done():
+                            fut.set_exception(exc)
+                else:
+                    for _, fut in batch:
+                        if not fut.done():
+                            fut.set_result(None)
+        finally:
+            _writer_task = None
+
+    async def _persist(guid: Optional[str], state: bool):
+        """
+        Wait until the record `guid -> state` has been written to the journal.
+        With `guid=None`, wait for a compaction of the current state instead.
+        """
+        nonlocal _writer_task
+        record = pack_record(guid, state) if guid is not None else None
+        fut = asyncio.get_running_loop().create_future()
+        _pending.append((record, fut))
+        if _writer_task is None:
+            _writer_task = asyncio.create_task(_writer())
+        await fut
+
     # --- lifecycle ---
     async def on_startup():
-        print(f"[DEBUG] on_startup TOGGLES_FILE {TOGGLES_FILE}")
-        data = await _load_from_disk(TOGGLES_FILE)
+        nonlocal _serialized, _keep_snapshot
+        logger.debug("on_startup TOGGLES_FILE %s", TOGGLES_FILE)
+        data, skipped = await _load_from_disk(TOGGLES_FILE, _disk_writer)
+        _keep_snapshot = bool(skipped)
+        if skipped:
+            logger.warning(
+                "%s has %d non-GUID key(s); not compacting it until they are removed",
+                TOGGLES_FILE,
+                len(skipped),
+            )
         toggles.clear()
         toggles.update(data)
+        _serialized = None
+        await _ensure_journal()
 
     async def on_shutdown():
-        async with _store_lock:
-            await _save_to_disk(TOGGLES_FILE, toggles)
+        nonlocal _journal_fd, _journal_bytes
+        await _persist(None, False)
+        if _writer_task is not None:
+            await _writer_task
+        if _journal_fd is not None:
+            os.close(_journal_fd)
+            _journal_fd = None
+            _journal_bytes = 0
+        _disk_writer.stop()
 
     @asynccontextmanager
     async def lifespan(app: FastAPI):
-        print("App starting up")
+        logger.info("App starting up")
         await on_startup()
         yield
         await on_shutdown()
-        print("App shutting down")
+        logger.info("App shutting down")
 
 
-    app = FastAPI(title="Toggle Service", lifespan=lifespan) 
+    app = FastAPI(title="Toggle Service", lifespan=lifespan)
 
     # --- middleware ---
     @app.middleware("http")
     async def log_request(request: Request, call_next):
-        body = await request.body()
-        print(f"Incoming request: {request.method} {request.url}")
-        print(f"Headers: {dict(request.headers)}")
-        if body:
-            try:
-                print(f"Body: {body.decode('utf-8')}")
-            except Exception:
-                print("Body: <binary data>")
-        response = await call_next(request)
-        return response
+        # Never touch request.body() here: it would buffer every request
+        # before routing.
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Incoming request: %s %s", request.method, request.url.path)
+        return await call_next(request)
+
+    # --- mutations ---
+    # Mutations run on the event loop thread and never await, so nothing can
+    # interleave with them and they need no lock. Disk I/O happens afterwards
+    # in the writer task.
+    def _create(guid: str) -> None:
+        nonlocal _serialized
+        toggles[guid] = False
+        _serialized = None
+
+    def _flip(guid: str) -> bool:
+        nonlocal _serialized
+        state = toggles.get(guid)
+        if state is None:
+            raise HTTPException(status_code=404, detail="Toggle not found")
+        state = toggles[guid] = not state
+        _serialized = None
+        return state
 
     # --- endpoints ---
     @app.post("/create")
     async def create_toggle():
-        guid = str(uuid.uuid4())
-        async with _store_lock:
-            toggles[guid] = False
-            await _save_to_disk(TOGGLES_FILE, toggles)
-        return {"guid": guid, "state": False}
+        guid = fast_guid()
+        _create(guid)
+        await _persist(guid, False)
+        # A fresh guid would only evict hot /status entries from the cache.
+        body = orjson.dumps({"guid": guid, "state": False})
+        return Response(body, media_type="application/json")
 
     @app.post("/toggle/{guid}")
     async def toggle_state(guid: str):
-        async with _store_lock:
-            if guid not in toggles:
-                raise HTTPException(status_code=404, detail="Toggle not found")
-            toggles[guid] = not toggles[guid]
-            await _save_to_disk(TOGGLES_FILE, toggles)
-            return {"guid": guid, "state": toggles[guid]}
+        if not _valid_guid(guid):
+            raise HTTPException(status_code=422, detail="Invalid toggle id")
+        state = _flip(guid)
+        await _persist(guid, state)
+        return Response(_toggle_body(guid, state), media_type="application/json")
 
     @app.get("/status/{guid}")
-    async def get_status(guid: str):
-        if guid not in toggles:
+    def get_status(guid: str):
+        if not _valid_guid(guid):
+            raise HTTPException(status_code=422, detail="Invalid toggle id")
+        state = toggles.get(guid)
+        if state is None:
             raise HTTPException(status_code=404, detail="Toggle not found")
-        return {"guid": guid, "state": toggles[guid]}
+        return Response(_toggle_body(guid, state), media_type="application/json")
 
     # expose internals for testing (lightweight)
     app.state._toggles = toggles
-    app.state._store_lock = _store_lock
     app.state._toggles_file = TOGGLES_FILE
 
     return app
@@ -1,13 +1,76 @@
 import os
-import json
+import logging
+import orjson
 import tempfile
 import asyncio
-from typing import Dict
+import mmap
+import queue
+import struct
+import threading
+import uuid
+from contextlib import contextmanager
+from typing import Any, BinaryIO, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
 
+logger = logging.getLogger(__name__)
 
-def _save_sync(path: str, data: Dict[str, bool]) -> None:
+# Not every platform has O_DSYNC; without it appends fall back to fsync.
+_O_DSYNC = getattr(os, "O_DSYNC", 0)
+
+
+# Journal records are fixed-size: the 16 raw GUID bytes and a state byte.
+JOURNAL_RECORD = struct.Struct("<16sB")
+
+
+def format_guid(b: bytes) -> str:
+    """Format 16 raw bytes as a canonical lowercase GUID string."""
+    h = b.hex()
+    return f"{h[:8]}-{h[8:12]}-{h[12:16]}-{h[16:20]}-{h[20:]}"
+
+
+def pack_record(guid: str, state: bool) -> bytes:
+    """
+    Encode one journal record. `guid` must be a canonical lowercase GUID;
+    anything else raises ValueError.
+    """
+    return JOURNAL_RECORD.pack(bytes.fromhex(guid.replace("-", "")), state)
+
+
+def _canonical_guid(key: str) -> Optional[str]:
+    """Return `key` in canonical lowercase GUID form, or None if it isn't one."""
+    try:
+        return str(uuid.UUID(key))
+    except (TypeError, ValueError):
+        return None
+
+
+def journal_path(path: str) -> str:
+    """Return the path of the append-only journal that accompanies `path`."""
+    return path + ".journal"
+
+
+def _write_all(fd: int, buf: bytes) -> None:
+    """Write all of `buf` to `fd`, retrying on short writes."""
+    view = memoryview(buf)
+    while view:
+        view = view[os.write(fd, view):]
+
+
+def _fsync_dir(dirpath: str) -> None:
+    """Make a rename inside `dirpath` durable by syncing the directory itself."""
+    try:
+        fd = os.open(dirpath, os.O_RDONLY)
+    except OSError:
+        # Some platforms (e.g. Windows) can't open directories; nothing to do.
+        return
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _save_bytes_sync(path: str, buf: bytes) -> None:
     """
-    Synchronously and atomically write `data` (a dict) to `path`.
+    Synchronously and atomically write the serialized snapshot `buf` to `path`.
     Uses a temporary file in the same directory and os.replace for atomicity.
     """
     dirpath = os.path.dirname(os.path.abspath(path)) or "."
@@ -15,42 +78,224 @@ def _save_sync(path: str, data: Dict[str, bool]) -> None:
 
     fd, tmp_path = tempfile.mkstemp(dir=dirpath)
     try:
-        with os.fdopen(fd, "w", encoding="utf-8") as f:
-            json.dump(data, f, indent=2, sort_keys=True)
-            f.flush()
-            os.fsync(f.fileno())
+        try:
+            _write_all(fd, buf)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
         os.replace(tmp_path, path)
+        _fsync_dir(dirpath)
+    except BaseException:
+        # The temp file is only left behind on failure; removing it here
+        # avoids an exists() stat on every successful write.
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+@contextmanager
+def _map_file(f: BinaryIO) -> Iterator[Optional[mmap.mmap]]:
+    """Map the open file `f` read-only; yields None for an empty file."""
+    if os.fstat(f.fileno()).st_size == 0:
+        yield None
+        return
+    mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        yield mm
     finally:
-        if os.path.exists(tmp_path):
-            try:
-                os.remove(tmp_path)
-            except OSError:
-                pass
+        mm.close()
 
 
-def _load_sync(path: str) -> Dict[str, bool]:
+def _load_sync(path: str) -> Tuple[Dict[str, bool], List[str]]:
     """
-    Synchronously load toggles from `path`. Returns an empty dict if the file
-    does not exist or contains invalid JSON.
+    Synchronously load toggles from `path`. Returns the toggles and the keys
+    that were skipped because they are not GUIDs. Returns an empty dict if
+    the file does not exist or contains invalid JSON.
     """
-    if not os.path.exists(path):
-        return {}
     try:
-        with open(path, "r", encoding="utf-8") as f:
-            data = json.load(f)
+        with open(path, "rb") as f, _map_file(f) as mm:
+            data = orjson.loads(memoryview(mm)) if mm is not None else None
             if isinstance(data, dict):
-                return {str(k): bool(v) for k, v in data.items()}
-    except (OSError, json.JSONDecodeError):
+                # Snapshots may be hand-edited: keys are normalized to the
+                # lowercase form the journal replays to, and values are
+                # coerced to bool. Keys that aren't GUIDs can't be journaled,
+                # so they are skipped and reported to the caller.
+                toggles = {}
+                skipped = []
+                for k, v in data.items():
+                    guid = _canonical_guid(k)
+                    if guid is None:
+                        logger.warning("Ignoring non-GUID key %r in %s", k, path)
+                        skipped.append(k)
+                    else:
+                        toggles[guid] = bool(v)
+                return toggles, skipped
+    except (OSError, orjson.JSONDecodeError):
         # If the file is corrupt/unreadable, return empty store to avoid crashing.
-        return {}
-    return {}
+        return {}, []
+    return {}, []
+
+
+def _replay_journal_sync(path: str, data: Dict[str, bool]) -> None:
+    """
+    Apply the records in the journal at `path` on top of `data` (last write
+    wins). A trailing partial record, i.e. a torn final write, is ignored.
+    """
+    try:
+        with open(path, "rb") as f, _map_file(f) as mm:
+            if mm is None:
+                return
+            view = memoryview(mm)
+            try:
+                end = len(view) - len(view) % JOURNAL_RECORD.size
+                for guid, state in JOURNAL_RECORD.iter_unpack(view[:end]):
+                    data[format_guid(guid)] = bool(state)
+            finally:
+                view.release()
+    except OSError:
+        return
+
+
+def _load_all_sync(path: str) -> Tuple[Dict[str, bool], List[str]]:
+    """
+    Load the snapshot at `path` and replay its journal on top of it. Also
+    returns the snapshot keys that were skipped (see `_load_sync`).
+    """
+    data, skipped = _load_sync(path)
+    _replay_journal_sync(journal_path(path), data)
+    return data, skipped
+
+
+def _open_journal_sync(path: str) -> int:
+    """
+    Open (creating if needed) the journal for `path` for appending. Where
+    available the fd is opened with O_DSYNC, so each write is durable on
+    return without a separate sync call.
+    """
+    jpath = journal_path(path)
+    dirpath = os.path.dirname(os.path.abspath(jpath)) or "."
+    os.makedirs(dirpath, exist_ok=True)
+    fd = os.open(jpath, os.O_WRONLY | os.O_APPEND | os.O_CREAT | _O_DSYNC, 0o644)
+    # Drop a torn final record so new appends stay record-aligned.
+    torn = os.fstat(fd).st_size % JOURNAL_RECORD.size
+    if torn:
+        os.ftruncate(fd, os.fstat(fd).st_size - torn)
+    return fd
+
+
+def _append_sync(fd: int, records: Iterable[bytes]) -> int:
+    """
+    Append `records` (encoded by `pack_record`) to the journal `fd` (opened
+    by `open_journal`) in a single write. Returns the number of bytes written.
+
+    Records are fixed-size with no separators, so a failed write (e.g. a
+    short write then ENOSPC) is rolled back to the previous end of the
+    journal; leaving partial bytes would misalign every later record.
+    """
+    buf = b"".join(records)
+    size_before = os.fstat(fd).st_size
+    try:
+        _write_all(fd, buf)
+        if not _O_DSYNC:
+            os.fsync(fd)
+    except BaseException:
+        os.ftruncate(fd, size_before)
+        raise
+    return len(buf)
+
+
+def _compact_sync(path: str, fd: int, snapshot: bytes) -> None:
+    """
+    Write the serialized `snapshot` to `path`, then truncate the journal.
+    The snapshot rename is made durable (directory fsync) before the journal
+    is truncated, so a crash at any point leaves either the old snapshot with
+    the full journal or the new snapshot; both replay to every acknowledged
+    mutation.
+    """
+    _save_bytes_sync(path, snapshot)
+    os.ftruncate(fd, 0)
+    os.fsync(fd)
+
+
+class WriterThread:
+    """
+    A single dedicated thread that runs persistence calls in submission
+    order. Callers await a future bound to their own loop, which avoids the
+    default executor dispatch on every write and keeps all writes to the
+    journal on one thread. The thread is started on first use.
+    """
+
+    def __init__(self, name: str = "toggle-writer") -> None:
+        self._name = name
+        self._queue: "queue.Queue[Optional[tuple]]" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+
+    def _run(self) -> None:
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            fn, args, fut, loop = item
+            try:
+                result = fn(*args)
+            except BaseException as exc:
+                loop.call_soon_threadsafe(_resolve, fut, None, exc)
+            else:
+                loop.call_soon_threadsafe(_resolve, fut, result, None)
+
+    async def run(self, fn: Callable[..., Any], *args: Any) -> Any:
+        """Run `fn(*args)` on the writer thread and return its result."""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name=self._name, daemon=True)
+            self._thread.start()
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        self._queue.put((fn, args, fut, loop))
+        return await fut
+
+    def stop(self) -> None:
+        """Let queued work finish, then stop the thread."""
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+
+def _resolve(fut: asyncio.Future, result: Any, exc: Optional[BaseException]) -> None:
+    if fut.done():
+        return
+    if exc is not None:
+        fut.set_exception(exc)
+    else:
+        fut.set_result(result)
+
+
+async def _offload(writer: Optional[WriterThread], fn: Callable[..., Any], *args: Any) -> Any:
+    """Run `fn(*args)` on `writer`, or on the default executor if it is None."""
+    if writer is None:
+        return await asyncio.to_thread(fn, *args)
+    return await writer.run(fn, *args)
+
+
+async def load(
+    path: str, writer: Optional[WriterThread] = None
+) -> Tuple[Dict[str, bool], List[str]]:
+    """Async wrapper that offloads the sync load (snapshot + journal) to a thread."""
+    return await _offload(writer, _load_all_sync, path)
+
+
+async def open_journal(path: str, writer: Optional[WriterThread] = None) -> int:
+    """Async wrapper that opens the journal fd for `path` in a thread."""
+    return await _offload(writer, _open_journal_sync, path)
 
 
-async def save(path: str, data: Dict[str, bool]) -> None:
-    """Async wrapper that offloads the sync write to a thread."""
-    await asyncio.to_thread(_save_sync, path, data)
+async def append(writer: WriterThread, fd: int, records: Iterable[bytes]) -> int:
+    """Async wrapper that runs a journal append on `writer`."""
+    return await writer.run(_append_sync, fd, list(records))
 
 
-async def load(path: str) -> Dict[str, bool]:
-    """Async wrapper that offloads the sync load to a thread."""
-    return await asyncio.to_thread(_load_sync, path)
+async def compact(writer: WriterThread, path: str, fd: int, snapshot: bytes) -> None:
+    """Async wrapper that runs snapshot compaction on `writer`."""
+    await writer.run(_compact_sync, path, fd, snapshot)